@@ -82,6 +82,11 @@ class Config(BaseConfig):
         exp_parser.add_argument('--dropout_pos', default='CDBR',
                                 help='CDBR (default; conv-dropout-BN-relu) / '
                                 'CBRD (conv-BN-relu-dropout) / FD (fractal_block-dropout)')
+        exp_parser.add_argument('--amp', default='none',
+                                help='mixed precision: none (default) / fp16 / bf16')
+        exp_parser.add_argument('--compile', default=False, action='store_true',
+                                help='torch.compile the model (fuses conv-BN-ReLU, less python '
+                                'overhead)')
 
         return parser
 
@@ -98,6 +103,7 @@ class Config(BaseConfig):
         self.dropout_probs = [float(p) for p in self.dropout_probs.split(',')]
         self.consist_gdrop = self.gdrop_type == 'ps-consist'
         assert self.gdrop_type in ['ps', 'ps-consist']
+        assert self.amp in ['none', 'fp16', 'bf16']
         assert len(self.dropout_probs) == self.blocks
 
         # learning rate decay 4 times.
@@ -2,54 +2,102 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 
 
 class Flatten(nn.Module):
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        return x.reshape(x.size(0), -1) # reshape: x can be channels_last
 
 
 class ConvBlock(nn.Module):
     """ Conv - Dropout - BN - ReLU """
     def __init__(self, C_in, C_out, kernel_size=3, stride=1, padding=1, dropout=None,
-                 pad_type='zero', dropout_pos='CDBR'):
+                 pad_type='zero', dropout_pos='CDBR', groups=1):
         """ Conv
         Args:
+            - C_in, C_out: channel in/out per group
             - dropout_pos: the position of dropout
                 - CDBR (default): conv-dropout-BN-relu
                 - CBRD: conv-BN-relu-dropout
                 - FD: fractal-dropout
+            - groups: # of independent convs packed into this block (grouped conv).
+                input/output channels are [group0 | group1 | ...].
         """
         super().__init__()
         self.dropout_pos = dropout_pos
+        self.groups = groups
         if pad_type == 'zero':
-            self.pad = nn.ZeroPad2d(padding)
+            # zero padding is done by conv itself (no extra padded tensor)
+            self.pad = nn.Identity()
+            conv_padding = padding
         elif pad_type == 'reflect':
             # [!] the paper used reflect padding - just for data augmentation?
             self.pad = nn.ReflectionPad2d(padding)
+            conv_padding = 0
         else:
             raise ValueError(pad_type)
 
-        self.conv = nn.Conv2d(C_in, C_out, kernel_size, stride, padding=0, bias=False)
+        self.conv = nn.Conv2d(C_in*groups, C_out*groups, kernel_size, stride,
+                              padding=conv_padding, groups=groups, bias=False)
         if dropout is not None and dropout > 0.:
-            self.dropout = nn.Dropout2d(p=dropout, inplace=True)
+            # inplace is safe only right after conv; relu_ needs its output for backward.
+            self.dropout = nn.Dropout2d(p=dropout, inplace=(dropout_pos == 'CDBR'))
         else:
             self.dropout = None
-        self.bn = nn.BatchNorm2d(C_out)
+        self.bn = nn.BatchNorm2d(C_out*groups)
 
     def forward(self, x):
         out = self.pad(x)
         out = self.conv(out)
-        if self.dropout_pos == 'CDBR' and self.dropout:
+        if self.dropout_pos == 'CDBR' and self.dropout and self.training:
             out = self.dropout(out)
         out = self.bn(out)
         out = F.relu_(out)
-        if self.dropout_pos == 'CBRD' and self.dropout:
+        if self.dropout_pos == 'CBRD' and self.dropout and self.training:
             out = self.dropout(out)
 
         return out
 
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """ Fold BN into conv weights: pad - conv(+bias) - relu.
+        Uses BN running stats, so the block is only valid for inference afterwards.
+        """
+        if isinstance(self.bn, nn.Identity):
+            return # already fused
+
+        conv, bn = self.conv, self.bn
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) # [C_out]
+        fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                          padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                          bias=True).to(conv.weight)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_(bn.bias - bn.running_mean * scale)
+
+        self.conv = fused
+        self.bn = nn.Identity()
+
+    def forward_group(self, x, g):
+        """ Run the g-th group only (eval only; e.g. the deepest column).
+        Args:
+            - x: input of the g-th group [B, C_in, H, W]
+            - g: group index
+        """
+        assert self.training is False
+        conv, bn = self.conv, self.bn
+        C_out = conv.out_channels // self.groups
+        sl = slice(g*C_out, (g+1)*C_out)
+
+        out = self.pad(x)
+        bias = conv.bias[sl] if conv.bias is not None else None
+        out = F.conv2d(out, conv.weight[sl], bias, conv.stride, conv.padding, conv.dilation)
+        if not isinstance(bn, nn.Identity):
+            out = F.batch_norm(out, bn.running_mean[sl], bn.running_var[sl], bn.weight[sl],
+                               bn.bias[sl], False, 0., bn.eps)
+        out = F.relu_(out)
+
+        return out
+
 
 class FractalBlock(nn.Module):
     def __init__(self, n_columns, C_in, C_out, p_ldrop, p_dropout, pad_type='zero',
@@ -73,6 +121,8 @@ class FractalBlock(nn.Module):
         self.n_columns = n_columns
         self.p_ldrop = p_ldrop
         self.dropout_pos = dropout_pos
+        # global drop masks only depend on (global_cols, n_cols); cached during a forward.
+        self._gdrop_cache = {} # n_cols -> gdrop mask
         if dropout_pos == 'FD' and p_dropout > 0.:
             self.dropout = nn.Dropout2d(p=p_dropout)
             p_dropout = 0.
@@ -85,104 +135,180 @@ class FractalBlock(nn.Module):
         else:
             self.doubler = None
 
-        self.columns = nn.ModuleList([nn.ModuleList() for _ in range(n_columns)])
         self.max_depth = 2 ** (n_columns-1)
 
-        dist = self.max_depth
-        self.count = np.zeros([self.max_depth], dtype=np.int)
-        for col in self.columns:
-            for i in range(self.max_depth):
-                if (i+1) % dist == 0:
-                    first_block = (i+1 == dist) # first block in this column
-                    if first_block and not doubling:
-                        # if doubling, always input channel size is C_out.
-                        cur_C_in = C_in
-                    else:
-                        cur_C_in = C_out
-
-                    module = ConvBlock(cur_C_in, C_out, dropout=p_dropout, pad_type=pad_type,
-                                       dropout_pos=dropout_pos)
-                    self.count[i] += 1
+        # The convs of the active columns at each depth are packed into a grouped ConvBlock,
+        # so a depth runs one conv-BN-ReLU instead of one per column.
+        # A column's first block may have a different C_in; it gets its own ConvBlock then.
+        self.depths = nn.ModuleList()
+        self.count = [0] * self.max_depth # # of active columns per depth
+        spans = []
+        for i in range(self.max_depth):
+            groups = [] # [C_in, c0, c1]
+            for c in range(n_columns):
+                dist = 2 ** (n_columns-1 - c)
+                if (i+1) % dist != 0:
+                    continue
+
+                first_block = (i+1 == dist) # first block in this column
+                if first_block and not doubling:
+                    # if doubling, always input channel size is C_out.
+                    cur_C_in = C_in
                 else:
-                    module = None
-
-                col.append(module)
+                    cur_C_in = C_out
 
-            dist //= 2
-
-    def drop_mask(self, B, global_cols, n_cols):
-        """ Generate drop mask; [n_cols, B].
-        1) generate global masks
+                if groups and groups[-1][0] == cur_C_in:
+                    groups[-1][2] = c+1
+                else:
+                    groups.append([cur_C_in, c, c+1])
+                self.count[i] += 1
+
+            self.depths.append(nn.ModuleList([
+                ConvBlock(cur_C_in, C_out, dropout=p_dropout, pad_type=pad_type,
+                          dropout_pos=dropout_pos, groups=c1-c0)
+                for cur_C_in, c0, c1 in groups
+            ]))
+            spans.append(tuple((c0, c1) for _, c0, c1 in groups))
+
+        # per-depth iteration schedule, precomputed as plain python ints:
+        # (st: first active column, spans: column range [c0, c1) of each ConvBlock in depths[i])
+        self._schedule = tuple((self.n_columns - self.count[i], spans[i])
+                               for i in range(self.max_depth))
+        # # of uniform random rows for the drop masks of a forward:
+        # n_cols (local drop) + 1 (resurrection) per join; single-column depths have no join.
+        self.n_drop_rands = sum(k+1 for k in self.count if k > 1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """ Pack weights of the legacy per-column layout (columns.{c}.{i}.*) into
+        the per-depth grouped layout (depths.{i}.{g}.*), so old checkpoints still load.
+        """
+        col_prefix = prefix + 'columns.'
+        if any(k.startswith(col_prefix) for k in state_dict):
+            for i, (_, spans) in enumerate(self._schedule):
+                for g, (c0, c1) in enumerate(spans):
+                    srcs = ['{}{}.{}.'.format(col_prefix, c, i) for c in range(c0, c1)]
+                    dst = '{}depths.{}.{}.'.format(prefix, i, g)
+                    names = [k[len(srcs[0]):] for k in state_dict if k.startswith(srcs[0])]
+                    for name in names:
+                        tensors = [state_dict.pop(src + name) for src in srcs]
+                        if tensors[0].dim() == 0:
+                            state_dict[dst + name] = tensors[0] # e.g. num_batches_tracked
+                        else:
+                            state_dict[dst + name] = torch.cat(tensors)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def drop_mask(self, B, global_cols, n_cols, rands=None):
+        """ Generate boolean drop mask (True = alive); [n_cols, B].
+        1) generate global masks (cached per n_cols during a forward)
         2) generate local masks
-        3) resurrect random path in all-dead column
-        4) concat global and local masks
+        3) concat global and local masks
+        4) resurrect random path in all-dead column; every sample has at least one alive.
 
         Args:
             - B: batch_size
-            - global_cols: global columns which to alive [GB]
+            - global_cols: global columns which to alive [GB] (LongTensor on device)
             - n_cols: the number of columns of mask
+            - rands: uniform randoms [n_cols+1, B]; drawn here if None
         """
+        device = global_cols.device
+        if rands is None:
+            rands = torch.rand([n_cols+1, B], device=device)
+        col_ids = torch.arange(n_cols, device=device).view(-1, 1) # [n_cols, 1]
+
         # global drop mask
-        GB = global_cols.shape[0]
-        # calc gdrop cols / samples
-        gdrop_cols = global_cols - (self.n_columns - n_cols)
-        gdrop_indices = np.where(gdrop_cols >= 0)[0]
-        # gen gdrop mask
-        gdrop_mask = np.zeros([n_cols, GB], dtype=np.float32)
-        gdrop_mask[gdrop_cols[gdrop_indices], gdrop_indices] = 1.
+        GB = global_cols.size(0)
+        gdrop_mask = self._gdrop_cache.get(n_cols)
+        if gdrop_mask is None:
+            # calc gdrop cols / samples
+            gdrop_cols = global_cols - (self.n_columns - n_cols)
+            # gen gdrop mask; samples whose global column is not in this join are all-dead.
+            # (their output is not used by their global column; resurrected below anyway)
+            gdrop_mask = col_ids == gdrop_cols.view(1, -1)
+            self._gdrop_cache[n_cols] = gdrop_mask
 
         # local drop mask
         LB = B - GB
-        ldrop_mask = np.random.binomial(1, 1.-self.p_ldrop, [n_cols, LB]).astype(np.float32)
-        alive_count = ldrop_mask.sum(axis=0)
-        # resurrect all-dead case
-        dead_indices = np.where(alive_count == 0.)[0]
-        ldrop_mask[np.random.randint(0, n_cols, size=dead_indices.shape), dead_indices] = 1.
+        ldrop_mask = rands[:n_cols, GB:] >= self.p_ldrop
 
-        drop_mask = np.concatenate((gdrop_mask, ldrop_mask), axis=1)
-        return torch.from_numpy(drop_mask)
+        drop_mask = torch.cat((gdrop_mask, ldrop_mask), dim=1)
+        # resurrect all-dead case, so join can divide by n_alive unconditionally
+        # (mask ops instead of index assignment to avoid device -> host sync)
+        dead = ~drop_mask.any(dim=0)
+        rand_cols = (rands[n_cols] * n_cols).long().clamp_max_(n_cols-1) # [B]
+        drop_mask |= (col_ids == rand_cols.view(1, -1)) & dead
 
-    def join(self, outs, global_cols):
+        return drop_mask
+
+    def join(self, outs, global_cols, rands=None):
         """
         Args:
             - outs: the outputs to join
             - global_cols: global drop path columns
+            - rands: uniform randoms for drop mask [n_cols+1, B]
         """
         n_cols = len(outs)
-        out = torch.stack(outs) # [n_cols, B, C, H, W]
+        if n_cols == 1:
+            # single column: nothing to join. global-drop samples whose column is not here
+            # are not used by later joins, so their output is don't-care.
+            return outs[0]
 
+        # weighted sum over columns without stacking outs into [n_cols, B, C, H, W]
         if self.training:
-            mask = self.drop_mask(out.size(1), global_cols, n_cols).to(out.device) # [n_cols, B]
-            mask = mask.view(*mask.size(), 1, 1, 1) # unsqueeze to [n_cols, B, 1, 1, 1]
-            n_alive = mask.sum(dim=0) # [B, 1, 1, 1]
-            masked_out = out * mask # [n_cols, B, C, H, W]
-            n_alive[n_alive == 0.] = 1. # all-dead cases
-            out = masked_out.sum(dim=0) / n_alive # [B, C, H, W] / [B, 1, 1, 1]
+            mask = self.drop_mask(outs[0].size(0), global_cols, n_cols, rands) # [n_cols, B]
+            n_alive = mask.sum(dim=0, dtype=torch.float32) # [B]
+            # weights of alive columns; no float copy of the mask. n_alive >= 1 by drop_mask.
+            w = torch.where(mask, 1. / n_alive, 0.) # [n_cols, B]
+            # running sum, accumulated in fp32 even under autocast (w is fp32).
+            # the first term initializes the buffer; no zero-filled buffer is needed.
+            # addcmul_ fuses the broadcast multiply and accumulate into one kernel.
+            out = outs[0] * w[0].view(-1, 1, 1, 1) # [B, C, H, W] * [B, 1, 1, 1]
+            for c in range(1, n_cols):
+                out.addcmul_(outs[c], w[c].view(-1, 1, 1, 1))
         else:
-            out = out.mean(dim=0) # no drop
+            # no drop; copy=True since outs[0] must not be modified inplace
+            out = outs[0].to(torch.float32, copy=True)
+            for o in outs[1:]:
+                out.add_(o)
+            out.div_(n_cols)
 
         return out
 
-    def forward(self, x, global_cols, deepest=False):
+    def forward(self, x, global_cols, deepest=False, drop_rands=None):
         """
-        global_cols works only in training mode.
+        global_cols and drop_rands work only in training mode.
+        drop_rands: uniform randoms for all drop masks of this forward [n_drop_rands, B].
+            FractalNet draws them for every block at once; drawn here if None.
         """
+        self._gdrop_cache.clear() # global_cols changes every forward
+        if self.training and drop_rands is None:
+            drop_rands = torch.rand([self.n_drop_rands, x.size(0)], device=x.device)
+        r = 0 # current row of drop_rands
+
         out = self.doubler(x) if self.doubler else x
         outs = [out] * self.n_columns
-        for i in range(self.max_depth):
-            st = self.n_columns - self.count[i]
-            cur_outs = [] # outs of current depth
+        for modules, (st, spans) in zip(self.depths, self._schedule):
             if deepest:
-                st = self.n_columns - 1 # last column only
+                # last column only; nothing to join.
+                # the last column is the last group of the last ConvBlock at every depth.
+                module = modules[-1]
+                outs[-1] = module.forward_group(outs[-1], module.groups-1)
+                continue
 
-            for c in range(st, self.n_columns):
-                cur_in = outs[c] # current input
-                cur_module = self.columns[c][i] # current module
-                cur_outs.append(cur_module(cur_in))
+            cur_outs = [] # outs of current depth
+            for module, (c0, c1) in zip(modules, spans):
+                # inputs of the packed columns: [B, (c1-c0)*C, H, W]
+                cur_in = torch.cat(outs[c0:c1], dim=1) if c1-c0 > 1 else outs[c0]
+                cur_outs.extend(module(cur_in).chunk(c1-c0, dim=1))
 
             # join
             #print("join in depth = {}, # of in_join = {}".format(i, len(cur_out)))
-            joined = self.join(cur_outs, global_cols)
+            n_cols = len(cur_outs)
+            rands = None
+            if self.training and n_cols > 1:
+                rands = drop_rands[r:r+n_cols+1]
+                r += n_cols+1
+            joined = self.join(cur_outs, global_cols, rands)
 
             for c in range(st, self.n_columns):
                 outs[c] = joined
@@ -195,8 +321,8 @@ class FractalBlock(nn.Module):
 
 class FractalNet(nn.Module):
     def __init__(self, data_shape, n_columns, init_channels, p_ldrop, dropout_probs,
-                 gdrop_ratio, gap=0, init='xavier', pad_type='zero', doubling=False,
-                 consist_gdrop=True, dropout_pos='CDBR'):
+                 gdrop_ratio, gap=2, init='xavier', pad_type='zero', doubling=False,
+                 consist_gdrop=True, dropout_pos='CDBR', amp='none'):
         """ FractalNet
         Args:
             - data_shape: (C, H, W, n_classes). e.g. (3, 32, 32, 10) - CIFAR 10.
@@ -206,6 +332,9 @@ class FractalNet(nn.Module):
             - dropout_probs: dropout probs (list)
             - gdrop_ratio: global droppath ratio
             - gap: pooling type for last block
+                - 0: max-pool - FC (the paper)
+                - 1: GAP - FC
+                - 2 (default): 1x1conv - GAP. cheapest head; no wide FC on C*size*size features
             - init: initializer type
             - pad_type: padding type of conv
             - doubling: if True, doubling by 1x1 conv in front of the block.
@@ -214,9 +343,17 @@ class FractalNet(nn.Module):
                 - CDBR (default): conv-dropout-BN-relu
                 - CBRD: conv-BN-relu-dropout
                 - FD: fractal_block-dropout
+            - amp: mixed precision (autocast) type
+                - none (default): fp32
+                - fp16 / bf16
         """
         super().__init__()
         assert dropout_pos in ['CDBR', 'CBRD', 'FD']
+        self.amp_dtype = {
+            'none': None,
+            'fp16': torch.float16,
+            'bf16': torch.bfloat16
+        }[amp]
 
         self.B = len(dropout_probs) # the number of blocks
         self.consist_gdrop = consist_gdrop
@@ -238,12 +375,13 @@ class FractalNet(nn.Module):
             if gap == 0 or b < self.B-1:
                 # Originally, every pool is max-pool in the paper (No GAP).
                 layers.append(nn.MaxPool2d(2))
+                size //= 2
             elif gap == 1:
                 # last layer and gap == 1
                 layers.append(nn.AdaptiveAvgPool2d(1)) # average pooling
-
-            size //= 2
+                size = 1
             total_layers += fb.max_depth
+            self.n_drop_rands = fb.n_drop_rands # same for every block
             C_in = C_out
             if b < self.B-2:
                 C_out *= 2 # doubling except for last block
@@ -268,28 +406,77 @@ class FractalNet(nn.Module):
                 'he': nn.init.kaiming_uniform_
             }[init]
 
-            for n, p in self.named_parameters():
-                if p.dim() > 1: # weights only
-                    initialize_(p)
-                else: # bn w/b or bias
-                    if 'bn.weight' in n:
-                        nn.init.ones_(p)
-                    else:
-                        nn.init.zeros_(p)
+            for m in self.modules():
+                if isinstance(m, (nn.Conv2d, nn.Linear)):
+                    # init each group of a grouped conv as an independent conv
+                    for w in m.weight.chunk(getattr(m, 'groups', 1)):
+                        initialize_(w)
+                    if m.bias is not None:
+                        nn.init.zeros_(m.bias)
+                elif isinstance(m, nn.BatchNorm2d):
+                    nn.init.ones_(m.weight)
+                    nn.init.zeros_(m.bias)
+
+        # NHWC is faster for the small-channel 3x3 convs (cudnn / oneDNN)
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, x, deepest=False):
         if deepest:
             assert self.training is False
         GB = int(x.size(0) * self.gdrop_ratio)
-        out = x
-        global_cols = None
-        for layer in self.layers:
-            if isinstance(layer, FractalBlock):
-                if not self.consist_gdrop or global_cols is None:
-                    global_cols = np.random.randint(0, self.n_columns, size=[GB])
+        out = x.contiguous(memory_format=torch.channels_last)
+        if self.training:
+            # global drop columns of every block in a single draw; [n_blocks, GB].
+            # consist_gdrop: one row shared by all blocks.
+            n_draws = 1 if self.consist_gdrop else self.B
+            all_global_cols = torch.randint(0, self.n_columns, [n_draws, GB], device=x.device)
+            # uniform randoms of every drop mask of this step in a single draw
+            all_drop_rands = torch.rand([self.B, self.n_drop_rands, x.size(0)], device=x.device)
+
+        b = 0 # block index
+        with torch.autocast(x.device.type, dtype=self.amp_dtype,
+                            enabled=self.amp_dtype is not None):
+            for layer in self.layers:
+                if isinstance(layer, FractalBlock):
+                    # global_cols works only in training mode
+                    if self.training:
+                        global_cols = all_global_cols[b % n_draws]
+                        drop_rands = all_drop_rands[b]
+                    else:
+                        global_cols, drop_rands = None, None
+                    b += 1
 
-                out = layer(out, global_cols, deepest=deepest)
-            else:
-                out = layer(out)
+                    out = layer(out, global_cols, deepest=deepest, drop_rands=drop_rands)
+                else:
+                    out = layer(out)
 
-        return out
+        return out.float()
+
+    def fuse_for_inference(self):
+        """ Fold BN into conv for every ConvBlock and switch to eval mode.
+        The fused model cannot be trained anymore.
+        """
+        self.eval()
+        for m in self.modules():
+            if isinstance(m, ConvBlock):
+                m.fuse_for_inference()
+        self.to(memory_format=torch.channels_last) # for the new fused convs
+
+        return self
+
+    @staticmethod
+    def wrap_ddp(model, device_id, find_unused_parameters=False):
+        """ Wrap the model with DistributedDataParallel for multi-GPU training.
+        Use DDP rather than DataParallel: the python-heavy forward (depth loop) is serialized
+        by the GIL in DataParallel's single process, while DDP runs one process per GPU.
+        The process group must be initialized before (torch.distributed.init_process_group).
+
+        Args:
+            - model: FractalNet
+            - device_id: local gpu id of this process
+            - find_unused_parameters: not needed by default; drop path only zeroes the join
+                weights of dropped columns, so every conv still gets a (zero) gradient.
+        """
+        model = model.to(device_id)
+        return nn.parallel.DistributedDataParallel(
+            model, device_ids=[device_id], find_unused_parameters=find_unused_parameters)
@@ -17,14 +17,17 @@ class ConvBlock(nn.Module):
         super().__init__()
 
         if pad_type == 'zero':
-            self.pad = nn.ZeroPad2d(padding)
+            # zero padding is done by conv itself (no extra padded tensor)
+            self.pad = nn.Identity()
+            conv_padding = padding
         elif pad_type == 'reflect':
             # [!] the paper used reflect padding - just for data augmentation?
             self.pad = nn.ReflectionPad2d(padding)
+            conv_padding = 0
         else:
             raise ValueError(pad_type)
 
-        self.conv = nn.Conv2d(C_in, C_out, kernel_size, stride, padding=0, bias=False)
+        self.conv = nn.Conv2d(C_in, C_out, kernel_size, stride, padding=conv_padding, bias=False)
         if dropout is not None and dropout > 0.:
             self.dropout = nn.Dropout2d(p=dropout, inplace=True)
         else:
@@ -71,7 +74,7 @@ class FractalBlock(nn.Module):
             self.doubler = None
 
         dist = self.max_depth
-        self.count = np.zeros([self.max_depth], dtype=np.int)
+        self.count = [0] * self.max_depth # # of active columns per depth
         for col in self.columns:
             for i in range(self.max_depth):
                 if (i+1) % dist == 0:
@@ -92,7 +95,7 @@ class FractalBlock(nn.Module):
 
     def local_drop_sampler(self, N):
         """ drop path probs sampler """
-        drops = np.random.binomial(1, self.p_local_drop, size=[N]).astype(np.bool)
+        drops = np.random.binomial(1, self.p_local_drop, size=[N]).astype(bool)
         if drops.all(): # all droped case
             i = np.random.randint(0, N)
             drops[i] = False
@@ -168,7 +171,7 @@ class FractalBlock(nn.Module):
 
 class FractalNet(nn.Module):
     def __init__(self, data_shape, n_columns, channels, p_local_drop, dropout_probs,
-                 global_drop_ratio, gap=0, init='xavier', pad_type='zero', doubling=False):
+                 global_drop_ratio, gap=2, init='xavier', pad_type='zero', doubling=False):
         """
         Args:
             - data_shape: (C, H, W, n_classes). e.g. (3, 32, 32, 10) - CIFAR 10.
@@ -177,6 +180,10 @@ class FractalNet(nn.Module):
             - p_local_drop: local drop prob
             - dropout_probs: dropout probs (list)
             - global_drop_ratio: global droppath ratio
+            - gap: pooling type for last block
+                - 0: max-pool - FC (the paper)
+                - 1: GAP - FC
+                - 2 (default): 1x1conv - GAP. cheapest head; no wide FC on C*size*size features
         """
         super().__init__()
         self.B = len(channels) # the number of blocks
@@ -197,18 +204,18 @@ class FractalNet(nn.Module):
             if gap == 0 or b < self.B-1:
                 # Originally, every pool is max-pool in the paper (No GAP).
                 layers.append(nn.MaxPool2d(2))
+                size //= 2
             elif gap == 1:
                 # last layer and gap == 1
                 layers.append(nn.AdaptiveAvgPool2d(1)) # average pooling
-
-            size //= 2
+                size = 1
             total_layers += fb.max_depth
 
         print("Last featuremap size = {}".format(size))
         print("Total layers = {}".format(total_layers))
 
         if gap == 2:
-            layers.append(nn.Conv2d(channels[-1], 10, 1, padding=0)) # 1x1 conv
+            layers.append(nn.Conv2d(channels[-1], n_classes, 1, padding=0)) # 1x1 conv
             layers.append(nn.AdaptiveAvgPool2d(1)) # gap
             layers.append(Flatten())
         else:
@@ -219,14 +226,14 @@ class FractalNet(nn.Module):
 
         if init == 'xavier':
             # xavier init as in the paper
-            for n, p in self.named_parameters():
-                if p.dim() > 1: # weights only
-                    nn.init.xavier_uniform_(p)
-                else: # bn w/b or bias
-                    if 'bn.weight' in n:
-                        nn.init.ones_(p)
-                    else:
-                        nn.init.zeros_(p)
+            for m in self.modules():
+                if isinstance(m, (nn.Conv2d, nn.Linear)):
+                    nn.init.xavier_uniform_(m.weight)
+                    if m.bias is not None:
+                        nn.init.zeros_(m.bias)
+                elif isinstance(m, nn.BatchNorm2d):
+                    nn.init.ones_(m.weight)
+                    nn.init.zeros_(m.bias)
 
     def forward(self, x):
         out = self.net(x)
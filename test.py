@@ -74,6 +74,7 @@ if __name__ == "__main__":
 
     state_dict = torch.load(path)
     model.load_state_dict(state_dict)
+    model.fuse_for_inference() # fold BN into conv
 
     print("full model ...")
     full_acc = test(valid_loader, model, criterion, deepest=False)
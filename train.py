@@ -50,8 +50,12 @@ def main():
                        p_ldrop=config.p_ldrop, dropout_probs=config.dropout_probs,
                        gdrop_ratio=config.gdrop_ratio, gap=config.gap,
                        init=config.init, pad_type=config.pad, doubling=config.doubling,
-                       dropout_pos=config.dropout_pos, consist_gdrop=config.consist_gdrop)
+                       dropout_pos=config.dropout_pos, consist_gdrop=config.consist_gdrop,
+                       amp=config.amp)
     model = model.to(device)
+    # `model` is kept uncompiled for state_dict (compiled one has `_orig_mod.` prefix).
+    # fullgraph=False: the python control flow of FractalBlock may cause graph breaks.
+    net = torch.compile(model, dynamic=False, fullgraph=False) if config.compile else model
 
     # model size
     m_params = utils.param_size(model)
@@ -60,6 +64,8 @@ def main():
 
     # weights optimizer
     optimizer = torch.optim.SGD(model.parameters(), config.lr, momentum=config.momentum)
+    # loss scaling is only needed for fp16 (bf16 has the fp32 exponent range)
+    scaler = torch.amp.GradScaler('cuda', enabled=config.amp == 'fp16')
 
     # setup data loader
     train_loader = torch.utils.data.DataLoader(train_data,
@@ -80,11 +86,11 @@ def main():
         lr_scheduler.step()
 
         # training
-        train(train_loader, model, optimizer, criterion, epoch)
+        train(train_loader, net, optimizer, scaler, criterion, epoch)
 
         # validation
         cur_step = (epoch+1) * len(train_loader)
-        top1 = validate(valid_loader, model, criterion, epoch, cur_step)
+        top1 = validate(valid_loader, net, criterion, epoch, cur_step)
 
         # save
         if best_top1 < top1:
@@ -99,7 +105,7 @@ def main():
     logger.info("Final best Prec@1 = {:.4%}".format(best_top1))
 
 
-def train(train_loader, model, optimizer, criterion, epoch):
+def train(train_loader, model, optimizer, scaler, criterion, epoch):
     top1 = utils.AverageMeter()
     top5 = utils.AverageMeter()
     losses = utils.AverageMeter()
@@ -116,10 +122,11 @@ def train(train_loader, model, optimizer, criterion, epoch):
         N = X.size(0)
 
         optimizer.zero_grad()
-        logits = model(X)
+        logits = model(X) # autocast is applied inside the model
         loss = criterion(logits, y)
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         prec1, prec5 = utils.accuracy(logits, y, topk=(1, 5))
         losses.update(loss.item(), N)